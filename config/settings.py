@@ -35,8 +35,11 @@ FFPROBE_PATH = os.getenv('FFPROBE_PATH', 'ffprobe')
 # Processing
 TEMP_DIR = os.getenv('TEMP_DIR', '/tmp/voice_trimmer')  # Temporary directory for processing
 PROCESS_TIMEOUT = int(os.getenv('PROCESS_TIMEOUT', '300'))  # 5 minutes
+FFMPEG_CONCURRENCY = int(os.getenv('FFMPEG_CONCURRENCY', os.cpu_count() or 2))  # Parallel ffmpeg/ffprobe processes
+OUTPUT_CACHE_SIZE = int(os.getenv('OUTPUT_CACHE_SIZE', '32'))  # Converted voice messages kept in memory (0 disables)
 
 # Bot behavior
+CONNECTION_POOL_SIZE = int(os.getenv('CONNECTION_POOL_SIZE', '32'))  # Shared HTTP connections to the Telegram API
 REQUEST_KWARGS = {
     'connect_timeout': 10,
     'read_timeout': 10,
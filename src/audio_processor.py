@@ -3,13 +3,73 @@
 Audio processing module for converting audio files to voice messages
 """
 
+import asyncio
+import json
 import logging
-import subprocess
-from pathlib import Path
-from typing import Optional
+import os
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    from mutagen import File as MutagenFile
+    from mutagen.oggopus import OggOpus
+except ImportError:  # Fall back to ffprobe for everything
+    MutagenFile = None
+    OggOpus = None
 
 logger = logging.getLogger(__name__)
 
+# Fixed parts of the ffmpeg command line, built once at import
+_FFMPEG_PREFIX = (
+    'ffmpeg',
+    '-hide_banner',  # Skip the version/build banner
+    '-loglevel', 'error',  # Only report errors on stderr
+    '-nostdin',  # Never wait on stdin for interaction
+    '-threads', '0',  # Let ffmpeg pick the thread count
+)
+_FFMPEG_COPY_ARGS = ('-c:a', 'copy')
+_FFMPEG_OPUS_ARGS = (
+    '-acodec', 'libopus',  # Use Opus codec (Telegram voice format)
+    '-ab', '128k',  # Bitrate
+)
+_FFMPEG_OUTPUT_TAIL = (
+    '-vn',  # No video
+    '-f', 'ogg',  # Container has to be explicit when writing to a pipe
+    'pipe:1',
+)
+
+
+def _read_header_info(file_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read duration and stream layout from the container header with mutagen
+    
+    Args:
+        file_path: Path to audio file
+        
+    Returns:
+        Dict with 'duration', 'codec_name', 'sample_rate' and 'channels'
+        keys (codec_name is only set for Opus) or None if mutagen can't
+        read the file
+    """
+    if MutagenFile is None:
+        return None
+    
+    try:
+        audio = MutagenFile(file_path)
+        if audio is None or not audio.info.length:
+            return None
+        
+        is_opus = isinstance(audio, OggOpus)
+        return {
+            'duration': float(audio.info.length),
+            'codec_name': 'opus' if is_opus else None,
+            # Opus always decodes at 48 kHz, whatever the original rate was
+            'sample_rate': 48000 if is_opus else getattr(audio.info, 'sample_rate', None),
+            'channels': getattr(audio.info, 'channels', None),
+        }
+    except Exception as e:
+        logger.debug("mutagen could not read %s: %s", file_path, e)
+        return None
+
 
 class AudioProcessor:
     """Handles audio file processing and conversion"""
@@ -24,123 +84,221 @@ class AudioProcessor:
         'aac': 'aac',
     }
     
-    def __init__(self):
-        """Initialize audio processor"""
+    def __init__(self, max_concurrency: Optional[int] = None):
+        """
+        Initialize audio processor
+        
+        Args:
+            max_concurrency: Maximum number of ffmpeg/ffprobe processes
+                running at once (defaults to the number of CPU cores)
+        """
         self.logger = logging.getLogger(__name__)
+        self.max_concurrency = max_concurrency or os.cpu_count() or 2
+        # Created lazily so it binds to the running event loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
     
-    def get_duration(self, file_path: str) -> Optional[float]:
+    async def _run(self, cmd: list, timeout: float) -> Tuple[int, bytes, str]:
         """
-        Get duration of audio file in seconds
+        Run an external command without blocking the event loop
+        
+        At most max_concurrency commands run at the same time; further
+        calls wait for a free slot so the CPU is not overcommitted.
+        
+        Args:
+            cmd: Command and arguments
+            timeout: Timeout in seconds
+            
+        Returns:
+            Tuple of (return code, raw stdout, decoded stderr)
+            
+        Raises:
+            asyncio.TimeoutError: If the command did not finish in time
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async with self._semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+            except BaseException:
+                # Timeout or cancellation: don't leave the child running
+                # after its semaphore slot is released
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        
+        return (
+            proc.returncode,
+            stdout,
+            stderr.decode('utf-8', errors='replace')
+        )
+    
+    async def probe(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Probe duration and first audio stream of a file with a single ffprobe call
         
         Args:
             file_path: Path to audio file
             
         Returns:
-            Duration in seconds or None if failed
+            Dict with 'duration', 'codec_type' and 'codec_name' keys
+            (values may be None) or None if probing failed
         """
         try:
             cmd = [
                 'ffprobe',
+                '-hide_banner',
                 '-v', 'error',
-                '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1:noescapes=1',
+                '-select_streams', 'a:0',
+                '-show_entries', 'format=duration:stream=codec_type,codec_name',
+                '-of', 'json',
                 file_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+            returncode, stdout, stderr = await self._run(cmd, timeout=10)
             
-            if result.returncode == 0:
-                duration = float(result.stdout.strip())
-                self.logger.info(f"Audio duration: {duration}s")
-                return duration
-            else:
-                self.logger.error(f"ffprobe error: {result.stderr}")
+            if returncode != 0:
+                self.logger.error("ffprobe error: %s", stderr)
                 return None
+            
+            data = json.loads(stdout)
+            streams = data.get('streams') or [{}]
+            duration = data.get('format', {}).get('duration')
+            return {
+                'duration': float(duration) if duration is not None else None,
+                'codec_type': streams[0].get('codec_type'),
+                'codec_name': streams[0].get('codec_name'),
+            }
         
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             self.logger.error("ffprobe timeout")
             return None
+        except OSError as e:
+            self.logger.error("Error running ffprobe: %s", e)
+            return None
         except (ValueError, AttributeError) as e:
-            self.logger.error(f"Error parsing duration: {str(e)}")
+            self.logger.error("Error parsing ffprobe output: %s", e)
             return None
     
-    def convert_to_voice(
+    async def _read_header(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """Run _read_header_info in a worker thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _read_header_info, file_path
+        )
+    
+    async def get_duration(self, file_path: str) -> Optional[float]:
+        """
+        Get duration of audio file in seconds
+        
+        Common containers (MP3, OGG, FLAC, M4A, WAV) are parsed directly
+        with mutagen; ffprobe is only spawned for anything else.
+        
+        Args:
+            file_path: Path to audio file
+            
+        Returns:
+            Duration in seconds or None if failed
+        """
+        header = await self._read_header(file_path)
+        if header is not None:
+            self.logger.info("Audio duration: %ss", header['duration'])
+            return header['duration']
+        
+        info = await self.probe(file_path)
+        if info is None or info['duration'] is None:
+            self.logger.error("Failed to get audio duration")
+            return None
+        
+        self.logger.info("Audio duration: %ss", info['duration'])
+        return info['duration']
+    
+    async def convert_to_voice(
         self,
         input_path: str,
-        output_path: str,
         target_duration: int = 60,
         sample_rate: int = 48000,
-        channels: int = 1
-    ) -> bool:
+        channels: int = 1,
+        actual_duration: Optional[float] = None
+    ) -> Optional[bytes]:
         """
         Convert audio file to Telegram voice message format (OGG/OPUS)
         
+        The input is read from disk (some containers such as M4A need a
+        seekable input), while the encoded output is read straight from
+        ffmpeg's stdout instead of going through a temporary file.
+        
         Args:
             input_path: Path to input audio file
-            output_path: Path to output OGG file
             target_duration: Target duration in seconds
             sample_rate: Output sample rate (default 48000 for Telegram)
             channels: Number of channels (1 for mono)
+            actual_duration: Input duration in seconds, if already known
             
         Returns:
-            True if successful, False otherwise
+            Encoded OGG/OPUS data or None if conversion failed
         """
         try:
-            # First, get the actual duration
-            actual_duration = self.get_duration(input_path)
-            if actual_duration is None:
-                self.logger.error("Failed to get audio duration")
-                return False
+            # -t stops at end of stream when the input is shorter than the
+            # target, so the input is only clamped when its duration is known
+            trim_end = target_duration
+            if actual_duration is not None:
+                trim_end = min(target_duration, actual_duration)
             
-            # Determine if we need to trim or pad
-            trim_end = min(target_duration, actual_duration)
+            # Opus input that already matches the output layout (e.g. a
+            # forwarded voice message) only needs remuxing, not re-encoding
+            header = await self._read_header(input_path)
+            if (
+                header is not None
+                and header['codec_name'] == 'opus'
+                and header['sample_rate'] == sample_rate
+                and header['channels'] == channels
+            ):
+                codec_args = _FFMPEG_COPY_ARGS
+            else:
+                codec_args = (
+                    *_FFMPEG_OPUS_ARGS,
+                    '-ar', str(sample_rate),  # Sample rate
+                    '-ac', str(channels),  # Channels (mono)
+                )
             
             # FFmpeg command to convert to OGG/OPUS
             cmd = [
-                'ffmpeg',
+                *_FFMPEG_PREFIX,
+                '-t', str(trim_end),  # Trim on the input side so the rest isn't read
                 '-i', input_path,
-                '-t', str(trim_end),  # Trim to target duration
-                '-acodec', 'libopus',  # Use Opus codec (Telegram voice format)
-                '-ab', '128k',  # Bitrate
-                '-ar', str(sample_rate),  # Sample rate
-                '-ac', str(channels),  # Channels (mono)
-                '-vn',  # No video
-                '-y',  # Overwrite output
-                output_path
+                *codec_args,
+                *_FFMPEG_OUTPUT_TAIL
             ]
             
-            self.logger.info(f"Converting audio: {' '.join(cmd)}")
+            self.logger.info("Converting audio: %s", cmd)
             
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 minute timeout
-            )
+            returncode, voice_data, stderr = await self._run(cmd, timeout=300)  # 5 minute timeout
             
-            if result.returncode != 0:
-                self.logger.error(f"FFmpeg error: {result.stderr}")
-                return False
+            if returncode != 0:
+                self.logger.error("FFmpeg error: %s", stderr)
+                return None
             
-            # Verify output file exists and has content
-            output_file = Path(output_path)
-            if not output_file.exists() or output_file.stat().st_size == 0:
-                self.logger.error("Output file is empty or doesn't exist")
-                return False
+            # Verify ffmpeg actually produced some output
+            if not voice_data:
+                self.logger.error("FFmpeg produced no output")
+                return None
             
-            self.logger.info(
-                f"Successfully converted audio to {output_path} "
-                f"({output_file.stat().st_size} bytes)"
-            )
-            return True
+            self.logger.info("Successfully converted audio (%d bytes)", len(voice_data))
+            return voice_data
         
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             self.logger.error("FFmpeg timeout - file processing took too long")
-            return False
+            return None
         except Exception as e:
-            self.logger.error(f"Error during audio conversion: {str(e)}")
-            return False
+            self.logger.error("Error during audio conversion: %s", e)
+            return None
     
-    def validate_audio_file(self, file_path: str) -> bool:
+    async def validate_audio_file(self, file_path: str) -> bool:
         """
         Validate if file is a valid audio file
         
@@ -150,31 +308,21 @@ class AudioProcessor:
         Returns:
             True if valid audio file, False otherwise
         """
-        try:
-            cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-select_streams', 'a:0',
-                '-show_entries', 'stream=codec_type',
-                '-of', 'csv=p=0',
-                file_path
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            
-            is_valid = result.returncode == 0 and 'audio' in result.stdout
-            
-            if is_valid:
-                self.logger.info(f"Audio file validated: {file_path}")
-            else:
-                self.logger.warning(f"Invalid audio file: {file_path}")
-            
-            return is_valid
+        # A readable header with a non-zero length is enough for mutagen's
+        # formats; anything else needs ffprobe to find an audio stream
+        is_valid = await self._read_header(file_path) is not None
+        if not is_valid:
+            info = await self.probe(file_path)
+            is_valid = info is not None and info['codec_type'] == 'audio'
         
-        except Exception as e:
-            self.logger.error(f"Error validating audio file: {str(e)}")
-            return False
+        if is_valid:
+            self.logger.info("Audio file validated: %s", file_path)
+        else:
+            self.logger.warning("Invalid audio file: %s", file_path)
+        
+        return is_valid
     
-    def get_file_format(self, file_path: str) -> Optional[str]:
+    async def get_file_format(self, file_path: str) -> Optional[str]:
         """
         Detect audio file format
         
@@ -184,23 +332,9 @@ class AudioProcessor:
         Returns:
             Format string or None if detection failed
         """
-        try:
-            cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-select_streams', 'a:0',
-                '-show_entries', 'stream=codec_name',
-                '-of', 'default=noprint_wrappers=1:nokey=1:noescapes=1',
-                file_path
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            
-            if result.returncode == 0:
-                format_str = result.stdout.strip()
-                self.logger.info(f"Detected format: {format_str}")
-                return format_str
+        info = await self.probe(file_path)
+        if info is None or not info['codec_name']:
             return None
         
-        except Exception as e:
-            self.logger.error(f"Error detecting format: {str(e)}")
-            return None
+        self.logger.info("Detected format: %s", info['codec_name'])
+        return info['codec_name']
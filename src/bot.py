@@ -4,18 +4,31 @@ Telegram Voice Message Bot
 Converts music files to voice messages with specific length
 """
 
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import shutil
 import sys
 import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
 from datetime import datetime
+from typing import List, Optional, Tuple
+from uuid import uuid4
 
-from telegram import Update
+from telegram import InputFile, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from config.settings import TELEGRAM_TOKEN, MAX_DURATION, SUPPORTED_FORMATS, LOG_DIR
+from config.settings import (
+    TELEGRAM_TOKEN, MAX_DURATION, SUPPORTED_FORMATS, LOG_DIR, FFMPEG_CONCURRENCY, TEMP_DIR,
+    OUTPUT_CACHE_SIZE, CONNECTION_POOL_SIZE, REQUEST_KWARGS
+)
 from src.audio_processor import AudioProcessor
 
 # Configure logging
@@ -23,23 +36,99 @@ log_dir = Path(LOG_DIR)
 log_dir.mkdir(parents=True, exist_ok=True)
 log_file = log_dir / f"bot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
 
+# Handlers write from a background thread, so log calls on the event
+# loop only enqueue the record instead of blocking on disk writes
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+log_listener.start()
+# Flush queued records at exit, even if startup fails before run()
+atexit.register(log_listener.stop)
+
+# The listener's handlers apply the real format; the queue handler only
+# renders the message (and any traceback) before queueing the record
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
+    handlers=[queue_handler]
 )
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class EncodeJob:
+    """A downloaded file waiting to be converted and sent back"""
+    input_path: str
+    work_dir: str
+    file_unique_id: str
+    target_duration: int
+    actual_duration: Optional[float]
+    chat_id: int
+    reply_to_message_id: int
+    user_id: int
+
+
+class UserSession:
+    """Per-user conversation state, stored once in context.user_data"""
+    __slots__ = (
+        'processing',
+        'target_duration',
+        'file_path',
+        'file_unique_id',
+        'probed_duration',
+        'work_dir',
+    )
+    
+    processing: bool
+    target_duration: Optional[int]
+    file_path: Optional[str]
+    file_unique_id: Optional[str]
+    probed_duration: Optional[float]
+    work_dir: Optional[str]
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """Return to the idle state, waiting for a new file"""
+        self.processing = False
+        self.target_duration = None
+        self.file_path = None
+        self.file_unique_id = None
+        self.probed_duration = None
+        self.work_dir = None
+
+
+def _session(context: ContextTypes.DEFAULT_TYPE) -> UserSession:
+    """Get the user's session, creating it on first use"""
+    return context.user_data.setdefault('session', UserSession())
+
+
 class VoiceMessageBot:
     """Main bot class for handling Telegram interactions"""
     
     def __init__(self):
-        self.audio_processor = AudioProcessor()
+        self.audio_processor = AudioProcessor(max_concurrency=FFMPEG_CONCURRENCY)
         self.application = None
+        # Created in run() so they bind to the running event loop
+        self.encode_queue: Optional[asyncio.Queue] = None
+        self.encode_workers: List[asyncio.Task] = []
+        # Converted voice messages keyed by (file_unique_id, target_duration),
+        # least recently used first
+        self.output_cache: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+        
+        # One temp directory for the bot's lifetime; each request gets its
+        # own subdirectory inside it
+        Path(TEMP_DIR).mkdir(parents=True, exist_ok=True)
+        self.temp_root = Path(tempfile.mkdtemp(prefix='vt_', dir=TEMP_DIR))
+        atexit.register(shutil.rmtree, self.temp_root, ignore_errors=True)
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
@@ -81,8 +170,11 @@ class VoiceMessageBot:
     
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /cancel command"""
-        if context.user_data.get('processing'):
-            context.user_data['processing'] = False
+        session = _session(context)
+        if session.processing:
+            if session.work_dir:
+                shutil.rmtree(session.work_dir, ignore_errors=True)
+            session.reset()
             await update.message.reply_text("Operation cancelled.")
             logger.info(f"User {update.effective_user.id} cancelled operation")
         else:
@@ -90,14 +182,21 @@ class VoiceMessageBot:
     
     async def handle_audio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle audio file uploads"""
+        session = _session(context)
         try:
-            if context.user_data.get('processing'):
+            # A file still waiting for its duration reply is replaced by the
+            # new upload; only an upload in progress blocks a new one
+            if session.processing and not session.work_dir:
                 await update.message.reply_text(
                     "I'm already processing a file. Please wait..."
                 )
                 return
             
-            context.user_data['processing'] = True
+            # Drop any earlier download that never got a duration
+            if session.work_dir:
+                shutil.rmtree(session.work_dir, ignore_errors=True)
+            session.reset()
+            session.processing = True
             user_id = update.effective_user.id
             
             # Get the audio file
@@ -105,7 +204,7 @@ class VoiceMessageBot:
             
             if not audio:
                 await update.message.reply_text("Please send an audio file.")
-                context.user_data['processing'] = False
+                session.processing = False
                 return
             
             # Check file size (Telegram limit is 50MB for files)
@@ -113,7 +212,7 @@ class VoiceMessageBot:
                 await update.message.reply_text(
                     "File is too large. Maximum size is 50MB."
                 )
-                context.user_data['processing'] = False
+                session.processing = False
                 return
             
             logger.info(f"User {user_id} sent audio file: {audio.file_name or 'unknown'}")
@@ -122,67 +221,80 @@ class VoiceMessageBot:
             processing_msg = await update.message.reply_text("Downloading file...")
             file = await context.bot.get_file(audio.file_id)
             
-            with tempfile.TemporaryDirectory() as temp_dir:
-                input_path = Path(temp_dir) / (audio.file_name or f"audio_{user_id}")
+            work_dir = self.temp_root / f"{user_id}_{uuid4().hex}"
+            work_dir.mkdir()
+            keep_work_dir = False
+            try:
+                input_path = work_dir / (audio.file_name or f"audio_{user_id}")
                 await file.download_to_drive(input_path)
                 
                 # Ask for duration if not provided
-                if not context.user_data.get('target_duration'):
-                    context.user_data['file_path'] = str(input_path)
+                if not session.target_duration:
+                    session.file_path = str(input_path)
+                    session.file_unique_id = audio.file_unique_id
+                    session.work_dir = str(work_dir)
+                    keep_work_dir = True
+                    # Only probe when the duration is shown to the user, and
+                    # keep it so the conversion doesn't need to probe again
+                    session.probed_duration = await self.audio_processor.get_duration(
+                        str(input_path)
+                    )
                     await processing_msg.edit_text(
-                        f"File received! Current duration: {self.audio_processor.get_duration(str(input_path))}s\n\n"
+                        f"File received! Current duration: {session.probed_duration}s\n\n"
                         f"Reply with desired duration (1-{MAX_DURATION} seconds):"
                     )
                     return
                 
                 # Process the audio
-                target_duration = context.user_data.get('target_duration', MAX_DURATION)
+                target_duration = session.target_duration or MAX_DURATION
                 
-                await processing_msg.edit_text("Processing audio...")
-                output_path = Path(temp_dir) / "output.ogg"
-                
-                success = self.audio_processor.convert_to_voice(
+                await self._queue_encode(
+                    update,
                     str(input_path),
-                    str(output_path),
-                    target_duration
+                    str(work_dir),
+                    audio.file_unique_id,
+                    target_duration,
+                    None
+                )
+                keep_work_dir = True
+                await processing_msg.edit_text(
+                    f"Queued for processing ({self.encode_queue.qsize()} in queue)..."
                 )
-                
-                if not success:
-                    await processing_msg.edit_text(
-                        "Failed to process audio. Please try again."
-                    )
-                    context.user_data['processing'] = False
-                    return
-                
-                # Send as voice message
-                await processing_msg.edit_text("Sending voice message...")
-                
-                with open(output_path, 'rb') as voice_file:
-                    await update.message.reply_voice(
-                        voice_file,
-                        duration=target_duration,
-                        caption=f"Duration: {target_duration}s"
-                    )
-                
-                await processing_msg.edit_text("✅ Done!")
-                logger.info(f"Successfully processed audio for user {user_id}")
                 
                 # Reset user data
-                context.user_data['processing'] = False
-                context.user_data['target_duration'] = None
-                context.user_data['file_path'] = None
+                session.reset()
+            finally:
+                # Keep the download while it waits for a duration reply or
+                # an encode worker; those clean it up later
+                if not keep_work_dir:
+                    shutil.rmtree(work_dir, ignore_errors=True)
         
         except Exception as e:
             logger.error(f"Error processing audio: {str(e)}")
             await update.message.reply_text(
                 f"An error occurred: {str(e)}\n\nPlease try again."
             )
-            context.user_data['processing'] = False
+            # Don't leave a half-finished download behind in the session
+            if session.work_dir:
+                shutil.rmtree(session.work_dir, ignore_errors=True)
+            session.reset()
+    
+    async def handle_unsupported_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle documents that aren't audio files"""
+        await update.message.reply_text(
+            "This file doesn't look like audio.\n"
+            "Supported formats: " + ", ".join(SUPPORTED_FORMATS)
+        )
+        logger.info(
+            f"User {update.effective_user.id} sent unsupported document "
+            f"({update.message.document.mime_type or 'unknown type'})"
+        )
     
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages (duration specification)"""
+        session = _session(context)
         try:
-            if context.user_data.get('file_path'):
+            if session.file_path:
                 # User is specifying duration
                 try:
                     duration = int(update.message.text)
@@ -192,44 +304,41 @@ class VoiceMessageBot:
                         )
                         return
                     
-                    context.user_data['target_duration'] = duration
-                    
-                    # Process the file
-                    await update.message.reply_text("Processing audio...")
+                    session.target_duration = duration
                     
-                    input_path = context.user_data['file_path']
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        output_path = Path(temp_dir) / "output.ogg"
-                        
-                        success = self.audio_processor.convert_to_voice(
-                            input_path,
-                            str(output_path),
-                            duration
+                    # Telegram keeps file_unique_id stable for the same file, so
+                    # a repeat with the same duration is answered without
+                    # queueing behind other users' encodes
+                    cache_key = (session.file_unique_id, duration)
+                    voice_data = self.output_cache.get(cache_key)
+                    if voice_data is not None:
+                        self.output_cache.move_to_end(cache_key)
+                        logger.info(f"Using cached voice message for user {update.effective_user.id}")
+                        await update.message.reply_voice(
+                            InputFile(voice_data, filename='voice.ogg'),
+                            duration=duration,
+                            caption=f"Duration: {duration}s"
                         )
-                        
-                        if not success:
-                            await update.message.reply_text(
-                                "Failed to process audio. Please try again."
-                            )
-                            return
-                        
-                        # Send as voice message
-                        with open(output_path, 'rb') as voice_file:
-                            await update.message.reply_voice(
-                                voice_file,
-                                duration=duration,
-                                caption=f"Duration: {duration}s"
-                            )
-                        
-                        logger.info(
-                            f"User {update.effective_user.id} created voice message "
-                            f"with {duration}s duration"
-                        )
-                        
-                        # Reset user data
-                        context.user_data['processing'] = False
-                        context.user_data['target_duration'] = None
-                        context.user_data['file_path'] = None
+                        shutil.rmtree(session.work_dir, ignore_errors=True)
+                        session.reset()
+                        return
+                    
+                    # Hand the file over to the encode workers, so the user
+                    # can send the next file while this one is converted
+                    await self._queue_encode(
+                        update,
+                        session.file_path,
+                        session.work_dir,
+                        session.file_unique_id,
+                        duration,
+                        session.probed_duration
+                    )
+                    await update.message.reply_text(
+                        f"Queued for processing ({self.encode_queue.qsize()} in queue)..."
+                    )
+                    
+                    # Reset user data; the queued job now owns the work dir
+                    session.reset()
                 
                 except ValueError:
                     await update.message.reply_text(
@@ -245,27 +354,124 @@ class VoiceMessageBot:
             logger.error(f"Error handling text: {str(e)}")
             await update.message.reply_text("An error occurred. Please try again.")
     
+    async def _queue_encode(
+        self,
+        update: Update,
+        input_path: str,
+        work_dir: str,
+        file_unique_id: str,
+        target_duration: int,
+        actual_duration: Optional[float]
+    ):
+        """Put a downloaded file on the encode queue"""
+        await self.encode_queue.put(EncodeJob(
+            input_path=input_path,
+            work_dir=work_dir,
+            file_unique_id=file_unique_id,
+            target_duration=target_duration,
+            actual_duration=actual_duration,
+            chat_id=update.effective_chat.id,
+            reply_to_message_id=update.message.message_id,
+            user_id=update.effective_user.id
+        ))
+    
+    async def _encode_worker(self):
+        """Convert queued files and send the voice messages back"""
+        while True:
+            job = await self.encode_queue.get()
+            try:
+                # Telegram keeps file_unique_id stable for the same file, so
+                # re-sent files with the same duration skip ffmpeg entirely
+                cache_key = (job.file_unique_id, job.target_duration)
+                voice_data = self.output_cache.get(cache_key)
+                if voice_data is not None:
+                    self.output_cache.move_to_end(cache_key)
+                    logger.info(f"Using cached voice message for user {job.user_id}")
+                else:
+                    voice_data = await self.audio_processor.convert_to_voice(
+                        job.input_path,
+                        job.target_duration,
+                        actual_duration=job.actual_duration
+                    )
+                    if voice_data is not None and OUTPUT_CACHE_SIZE > 0:
+                        self.output_cache[cache_key] = voice_data
+                        if len(self.output_cache) > OUTPUT_CACHE_SIZE:
+                            self.output_cache.popitem(last=False)
+                
+                if voice_data is None:
+                    await self.application.bot.send_message(
+                        job.chat_id,
+                        "Failed to process audio. Please send the file again.",
+                        reply_to_message_id=job.reply_to_message_id
+                    )
+                    continue
+                
+                # Send as voice message; the named InputFile wraps the bytes
+                # without another copy and gets an audio/ogg content type
+                await self.application.bot.send_voice(
+                    job.chat_id,
+                    InputFile(voice_data, filename='voice.ogg'),
+                    duration=job.target_duration,
+                    caption=f"Duration: {job.target_duration}s",
+                    reply_to_message_id=job.reply_to_message_id
+                )
+                
+                logger.info(
+                    f"User {job.user_id} created voice message "
+                    f"with {job.target_duration}s duration"
+                )
+            
+            except Exception as e:
+                logger.error(f"Error encoding audio for user {job.user_id}: {str(e)}")
+            finally:
+                shutil.rmtree(job.work_dir, ignore_errors=True)
+                self.encode_queue.task_done()
+    
     def setup_handlers(self):
         """Setup command and message handlers"""
         self.application.add_handler(CommandHandler("start", self.start))
         self.application.add_handler(CommandHandler("help", self.help_command))
         self.application.add_handler(CommandHandler("cancel", self.cancel))
         
-        # Handle audio files
+        # Handle audio files; documents only if their MIME type is audio/*
         self.application.add_handler(MessageHandler(
-            filters.AUDIO | filters.VOICE | (filters.Document() & ~filters.COMMAND),
+            filters.AUDIO | filters.VOICE | filters.Document.AUDIO,
             self.handle_audio
         ))
         
+        # Reject any other documents without downloading or probing them
+        self.application.add_handler(MessageHandler(
+            filters.Document.ALL,
+            self.handle_unsupported_document
+        ))
+        
         # Handle text messages
         self.application.add_handler(MessageHandler(filters.TEXT, self.handle_text))
     
     async def run(self):
         """Start the bot"""
-        self.application = Application.builder().token(TELEGRAM_TOKEN).build()
+        # One shared connection pool for all API calls and file transfers, so
+        # connections (and their TLS handshakes) are reused across requests.
+        # getUpdates keeps its own default request, since long polling would
+        # otherwise hold one of these connections the whole time.
+        request = HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE, **REQUEST_KWARGS)
+        self.application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .request(request)
+            .build()
+        )
         
         self.setup_handlers()
         
+        # One worker per ffmpeg slot; max_concurrency is already resolved
+        # to the CPU count when FFMPEG_CONCURRENCY is 0
+        self.encode_queue = asyncio.Queue()
+        self.encode_workers = [
+            asyncio.create_task(self._encode_worker())
+            for _ in range(self.audio_processor.max_concurrency)
+        ]
+        
         logger.info("Starting Telegram bot...")
         await self.application.initialize()
         await self.application.start()
@@ -273,9 +479,15 @@ class VoiceMessageBot:
         logger.info("Bot is running. Press Ctrl+C to stop.")
         
         try:
-            await self.application.updater.stop()
-        except KeyboardInterrupt:
+            # Serve until cancelled (Ctrl+C cancels the main task)
+            await asyncio.Event().wait()
+        except (KeyboardInterrupt, asyncio.CancelledError):
             logger.info("Bot stopped by user")
+        finally:
+            for worker in self.encode_workers:
+                worker.cancel()
+            await asyncio.gather(*self.encode_workers, return_exceptions=True)
+            await self.application.updater.stop()
             await self.application.stop()
             await self.application.shutdown()
 
@@ -283,7 +495,6 @@ class VoiceMessageBot:
 def main():
     """Main entry point"""
     bot = VoiceMessageBot()
-    import asyncio
     asyncio.run(bot.run())
 
 